@@ -16,6 +16,8 @@ GRAPH_FOLDER = GENDER + 'graphs'
 RESULTS_FILE = GENDER + "results"
 TRAIN_TEST_COL = 'year'
 SEED = 0
+# number of models to fit in parallel (-1 uses all cores)
+N_JOBS = -1
 
 # done with race, gender, age, incarceration lens, county, minmaxterm, 
 # sentences, penalty, offenses, infractions
@@ -56,8 +58,10 @@ VARIABLES = {
 
 
 ## RUNNING THE MODELS
-# Note: DT must be the last model to run
 GRIDSIZE = 'small'
+# max number of parameter combinations randomly sampled from each model's grid
+# (None runs the full grid)
+N_ITER = None
 MODELS = ['LR', 'RF', 'GB', 'DT']
 #MODELS = ['RF', 'ET', 'GB', 'AB', 'BAG', 'DT', 'KNN', 'LR', 'SVM', 'NB']
 YEARS = [2010, 2017]
@@ -70,6 +74,8 @@ ID = 'ID'
 PLOT_PR = 'save'
 # visualize decision tree
 VISUALIZE_DT = True
+# save histogram of scores for each model: true or false
+SAVE_HIST = False
 # save feature importance
 FEATURE_IMP = True
 # compute bias: true or false
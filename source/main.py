@@ -62,7 +62,8 @@ def preprocess(df, variables=config.VARIABLES):
 def main(gender = config.GENDER, genders=config.GENDERS, data_dir=config.DATA_DIR, results_dir=config.RESULTS_DIR, results_file=config.RESULTS_FILE, graphs_dir = config.GRAPH_FOLDER,
          variables=config.VARIABLES, models=config.MODELS, eval_metrics=config.EVAL_METRICS,
          eval_metrics_by_level=config.EVAL_METRICS_BY_LEVEL, grid=config.define_clfs_params(config.GRIDSIZE), 
-         period=config.YEARS, plot_pr = config.PLOT_PR, compute_bias = config.BIAS, save_pred = config.SAVE_PRED):
+         period=config.YEARS, plot_pr = config.PLOT_PR, compute_bias = config.BIAS, save_pred = config.SAVE_PRED,
+         n_jobs = config.N_JOBS, n_iter = config.N_ITER):
 
     # check if necessary data and results directories exist
     if not os.path.exists(data_dir):
@@ -134,7 +135,7 @@ def main(gender = config.GENDER, genders=config.GENDERS, data_dir=config.DATA_DI
     
         # run models
         results = pp.classify(df_train, df_test, label, models, eval_metrics, eval_metrics_by_level, grid, attributes_lst, 
-            bias_lst, bias_dict, year, genders, scaler, variables, results_dir, results_file, plot_pr, compute_bias, save_pred)
+            bias_lst, bias_dict, year, genders, scaler, variables, results_dir, results_file, plot_pr, compute_bias, save_pred, n_jobs, n_iter)
 
         year += 1
 
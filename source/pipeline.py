@@ -2,53 +2,33 @@
 # coding: utf-8
 
 ## Importing Packeges
+# plotting, sklearn, graphviz and aequitas are imported inside the functions
+# that use them, so the preprocessing helpers load quickly
 import pandas as pd
 import numpy as np
-import sys
-import graphviz 
-import matplotlib.pyplot as plt
-
-from scipy import stats
-from sklearn.model_selection import train_test_split
-from sklearn.model_selection import ParameterGrid 
-from sklearn.preprocessing import MinMaxScaler
-
-from sklearn import tree
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.tree import DecisionTreeClassifier
-from sklearn.linear_model import LogisticRegression
-from sklearn.svm import LinearSVC
-from sklearn.naive_bayes import MultinomialNB
-from sklearn.ensemble import (RandomForestClassifier, ExtraTreesClassifier,
-GradientBoostingClassifier, AdaBoostClassifier, BaggingClassifier)
-
-
-from sklearn.metrics import accuracy_score as accuracy, confusion_matrix, f1_score, auc, roc_auc_score, precision_score
-from sklearn.metrics import roc_curve, precision_recall_curve
-
-from sklearn.externals.six import StringIO
 import os
 import csv
-import graphviz
-import pydotplus
 import config
-from aequitas.group import Group
-from aequitas.plotting import Plot
-from textwrap import wrap
 
 
 ## Get Data
 
-def get_csv(f):
+def get_csv(f, dtype=None, usecols=None):
     '''
     Description: This function takes a csv file and uploads it into a pandas dataframe
     Input:
         csv: file to upload
+        dtype: (optional) dictionary of column types, to skip type inference
+        usecols: (optional) list of columns to load
     Output:
         pandas data frame
     '''
-
-    df = pd.read_csv(f)
+    # the multithreaded pyarrow reader needs pandas >= 1.4 and pyarrow installed,
+    # otherwise use the default C parser
+    try:
+        df = pd.read_csv(f, engine='pyarrow', dtype=dtype, usecols=usecols)
+    except (ImportError, ValueError):
+        df = pd.read_csv(f, engine='c', dtype=dtype, usecols=usecols)
     return df
 
 ## Pre-ProcessData
@@ -65,10 +45,14 @@ def remove_outliers(df, attribute_lst, sd_threshold=3):
     output:
     the new datafrane without outliers
     '''
-    zscore = lambda x: (x - x.mean())/x.std(ddof=0)
-    for attribute in attribute_lst:
-        df[attribute] = df[attribute][(np.abs(zscore(df[attribute])) < sd_threshold)]
-    return df
+    vals = df[attribute_lst].to_numpy(dtype=np.float64)
+    mu = np.nanmean(vals, axis=0)
+    sd = np.nanstd(vals, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.abs((vals - mu) / sd)
+    # missing values are not considered outliers
+    keep = ~(z >= sd_threshold).any(axis=1)
+    return df.loc[keep]
 
 def na_col(df):
     '''
@@ -93,9 +77,7 @@ def na_fill_col(df, col, fill_method = np.mean):
 
     Used in main.py
     '''
-    cp = df.copy()
-    cp.loc[cp[col].isna(), col] = fill_method(cp[col])
-    df[col] = cp[col]
+    df[col] = df[col].fillna(fill_method(df[col]))
     return df
 
 
@@ -112,22 +94,14 @@ def impute_with_2cols(df, year_col, pen_col, target_col):
     returns dataframe with imputed data
     Used in main.py
     '''
-    # find mean age given year and penalty class
-    def find_mean(year, pen_class):
-        #print(year)
-        #print(pen_class)
-        tmp = df[(df[year_col] == year) & (df[pen_col] == pen_class)]
-        #print(tmp)
-        return np.mean(tmp[target_col])
-    
-    # create binary missing column 
+    # create binary missing column
     # df = create_indicator(df, target_col)
 
-    # copy dataframe to impute values then reinsert into df
-    cp = df.copy()
-    cp[target_col]= cp.apply(lambda row: find_mean(row[year_col], row[pen_col]) if pd.isnull(row[target_col]) else row[target_col], axis=1)
-    cp.loc[cp[target_col].isna(), target_col] = find_mean(cp[year_col], cp[pen_col])
-    df[target_col] = cp[target_col]
+    # mean of target given year and penalty class, broadcast back to each row
+    group_means = df.groupby([year_col, pen_col])[target_col].transform('mean')
+    df[target_col] = df[target_col].fillna(group_means)
+    # last resort: overall mean for groups with no observed values
+    df[target_col] = df[target_col].fillna(df[target_col].mean())
     return df
 
 def impute_age(df, year_col, pen_col, len_col, age_start, age_end, age_first):
@@ -189,21 +163,13 @@ def fill_nan(df, attributes_lst, how='mean'):
     output:
         dataframe with the replaced nan
     '''   
-    if how == 'mean':
-        for attribute in attributes_lst: 
-            df[attribute].fillna(df[attribute].mean(), inplace=True)
-    elif how == 'max':
-        for attribute in attributes_lst: 
-            df[attribute].fillna(df[attribute].max(), inplace=True)
-    elif how == 'min':
-        for attribute in attributes_lst: 
-            df[attribute].fillna(df[attribute].min(), inplace=True)
-    elif how == 'median':
-        for attribute in attributes_lst: 
-            df[attribute].fillna(df[attribute].median(), inplace=True)
-    else:
+    if how not in ('mean', 'max', 'min', 'median'):
         raise Exception("This function only allows to fill the Nan with\
                         the mean, max, min or median of the observations")
+    # one fill value per column, filled in a single call
+    fills = df[attributes_lst].agg(how)
+    df[attributes_lst] = df[attributes_lst].fillna(fills)
+    return df
 
         
 def to_int(df, attribute_lst):
@@ -236,31 +202,29 @@ def to_date(df, attribute_lst, years_range=[1000, 3000]):
         a df with the corresponding None
     '''
     
-    #df = df.apply(out_of_range_to_none, axis=1, args=(years_range, attribute_lst))
     for var in attribute_lst:
         df[var] = df[var].astype('datetime64[s]')#, errors = 'ignore')
-    return df
+    return out_of_range_to_none(df, years_range, attribute_lst)
 
 
-def out_of_range_to_none(row, year_range, attributes_lst): 
+def out_of_range_to_none(df, year_range, attributes_lst):
     '''
-    Takes a row and a lists of columns and checks if the value falls out of the \
-    intended range. When it does, it converts it to None.
+    Takes a dataframe and a lists of columns and checks if the values fall out of the \
+    intended range. When they do, it converts them to None (NaT).
     input:
-        row: a series that represents a row
+        df: pandas data frame
         year_range: a tupple or list where the first year is the lowest bound \
         and the second is the highest bound of the range. Both years are included,\
         i.e. the bounds are not converted to None.
         attributes_lst: list of attributes names
     output:
-        a row with the corresponding None
+        a df with the corresponding None
     '''
-    
+
     for col in attributes_lst:
-        year = int(row[col].split("/")[2])
-        if year < year_range[0] or year > year_range[1]:
-            row[col] = None 
-    return row
+        years = pd.to_datetime(df[col], errors='coerce').dt.year
+        df.loc[(years < year_range[0]) | (years > year_range[1]), col] = pd.NaT
+    return df
 
 
 def impute_missing(df, col, fill_cat = 'MISSING'):
@@ -275,10 +239,7 @@ def impute_missing(df, col, fill_cat = 'MISSING'):
     '''
     # create binary missing column
     # df = pp.missing_col(df, col)
-    # copy dataframe to impute values then reinsert into df
-    cp = df.copy()
-    cp.loc[cp[col].isna(), col] = fill_cat
-    df[col] = cp[col]
+    df[col] = df[col].fillna(fill_cat)
     return df
 
 ## Generate Features/ Predictors
@@ -296,7 +257,16 @@ def discretize_variable(df, attribute_lst):
 
     for var in attribute_lst:
         new_var = var + 'cat'
-        df[new_var] = pd.qcut(df[var], 10, duplicates="drop", labels=False)
+        vals = df[var].to_numpy(dtype=np.float64)
+        # deciles, dropping duplicated edges
+        edges = np.unique(np.nanquantile(vals, np.linspace(0, 1, 11)))
+        # right-closed bins, i.e. same labels as pd.qcut(labels=False)
+        bins = np.searchsorted(edges[1:-1], vals).astype(np.int8)
+        missing = np.isnan(vals)
+        if missing.any():
+            # missing values stay missing, which needs a float column
+            bins = np.where(missing, np.nan, bins)
+        df[new_var] = bins
     return df
 
 def categorical_to_dummy(df, attribute_lst):
@@ -309,30 +279,53 @@ def categorical_to_dummy(df, attribute_lst):
         dataframe with the new variables
     ''' 
 
-    for var in attribute_lst:
-        tmp = df[var]
-        df = pd.get_dummies(df, columns=[var], dummy_na=False)
-        df.loc[:,var] = tmp
-    return df
+    # keep the original columns since get_dummies drops them
+    orig = df[attribute_lst].copy()
+    df = pd.get_dummies(df, columns=attribute_lst, dummy_na=False)
+    return pd.concat([df, orig], axis=1)
 
 def categorical_to_dummy_with_groupconcat(df, attribute_lst):
+    '''
+    Converts comma separated categorical variables (e.g. from a sql group_concat)
+    into one dummy for each category.
+    input:
+        df: pandas data frame
+        attributes_lst: list of attributes names
+    output:
+        dataframe with the new variables
+    '''
+    n = len(df)
+    # no rows means no categories, and nothing to concatenate below
+    if n == 0:
+        return df
+    dummies = []
     for var in attribute_lst:
-        dummy = df[var].str.get_dummies(sep=',')
-        for d in dummy.columns:
-            col_name = "{}_{}".format(var, d)
-            df[col_name] = dummy[d]
-    return df 
+        splits = df[var].fillna('').str.split(',')
+        lengths = splits.str.len().values
+        flat = np.concatenate(splits.values)
+        # sorted categories and the category index of every token
+        cats, cat_idx = np.unique(flat, return_inverse=True)
+        row_idx = np.repeat(np.arange(n), lengths)
+        res = np.zeros((n, len(cats)), dtype=np.int8)
+        res[row_idx, cat_idx] = 1
+        # empty tokens (missing values) do not get a dummy
+        keep = cats != ''
+        cols = ['{}_{}'.format(var, c) for c in cats[keep]]
+        dummies.append(pd.DataFrame(res[:, keep], index=df.index, columns=cols))
+    return pd.concat([df] + dummies, axis=1)
+
+flag_map = {'Y': 1, 'N': 0, 'Yes': 1, 'No': 0, 'T': 1, 'F': 0, 't': 1, 'f': 0,
+            'True': 1, 'False': 0, True: 1, False: 0, 'OPEN': 1, 'CLOSED': 0}
 
 def flag_to_dummy(df, attribute_lst, rename=True):
     '''
     Converts a flag variable to a dummy with 1 for Yes and 0 for No
+    (unrecognized or missing flags are set to 0)
     '''
     for var in attribute_lst:
-        df[var] = df[var].map({'Y': 1, 'N': 0, 'Yes': 1, 'No': 0, 'T': 1, 'F': 0, 't': 1, 'f': 0,
-                                     'True': 1, 'False': 0, True: 1, False: 0, 'OPEN': 1, 'CLOSED': 0})
-        if rename:
-            new_var_name = var[:-5]
-            df.rename(index=str, columns={var: new_var_name}, inplace=True)
+        df[var] = df[var].map(flag_map).fillna(0).astype('int8')
+    if rename:
+        df.rename(index=str, columns={var: var[:-5] for var in attribute_lst}, inplace=True)
     return df
 
 def gender_to_dummy(df, gender_var):  
@@ -354,7 +347,7 @@ def create_indicator(df, col, indicator_name='missing'):
     return: None
     '''
     missingcol = col + '_' + indicator_name
-    df[missingcol] = [1 if x else 0 for x in df[col].isna()]
+    df[missingcol] = df[col].isna().astype('int8')
     return df
 
 
@@ -369,12 +362,16 @@ def plot_scores_hist(df,col_score, model_name, output_type = 'save'):
     model_name: name of model
     output_type: 'save', 'show', ''
     '''
+    import matplotlib.pyplot as plt
+
     plt.clf()
     df[col_score].hist()
     plt.title(model_name)
     if output_type == 'save':
         f = os.path.join(config.GRAPH_FOLDER, model_name)
         plt.savefig(f)
+        # release the figure memory
+        plt.close()
     elif output_type == 'show':
         plt.show()
 
@@ -389,7 +386,9 @@ def plot_precision_recall_n(precision, recall, pct_pop, model_name, text, output
         text: text
         output_type: (str) save or show
     '''
-    plt.clf()
+    import matplotlib.pyplot as plt
+    from textwrap import wrap
+
     fig, ax1 = plt.subplots()
 
     #plot precision
@@ -418,10 +417,11 @@ def plot_precision_recall_n(precision, recall, pct_pop, model_name, text, output
     if (output_type == 'save'):
         pltfile = os.path.join(config.GRAPH_FOLDER,model_name)
         plt.savefig(pltfile)
+        plt.close(fig)
     elif (output_type == 'show'):
         plt.show()
     else:
-        pass
+        plt.close(fig)
 
 
     
@@ -435,6 +435,7 @@ def f1_at_threshold(y_true, y_predicted):
     Output:
         The F1 score
     '''
+    from sklearn.metrics import f1_score
     return  f1_score(y_true, y_predicted)
 
 
@@ -448,6 +449,7 @@ def accuracy_at_threshold(y_true, y_predicted):
     Output:
         The Accuracy score
     '''
+    from sklearn.metrics import confusion_matrix
     tn, fp, fn, tp = confusion_matrix(y_true, y_predicted).ravel()
     return 1.0 * (tp + tn) / (tn + fp + fn + tp )
 
@@ -461,6 +463,7 @@ def recall_at_threshold(y_true, y_predicted):
     Output:
         The Recall score
     '''
+    from sklearn.metrics import confusion_matrix
     _, _, fn, tp = confusion_matrix(y_true, y_predicted).ravel()
     return 1.0 * tp / (tp + fn)
 
@@ -475,25 +478,74 @@ def precision_at_threshold(y_true, y_predicted):
         The Precision score
     '''
     
+    from sklearn.metrics import confusion_matrix
     _, fp, _, tp = confusion_matrix(y_true, y_predicted).ravel()
     return 1.0 * tp / (tp + fp)
 
+def metrics_from_counts(tn, fp, fn, tp):
+    '''
+    This function calculates all the threshold-dependent evaluation metrics
+    from the counts of a confusion matrix.
+    Input:
+        tn, fp, fn, tp: true negatives, false positives, false negatives, true positives
+    Output:
+        dictionary with the accuracy, precision, recall and F1 scores
+    '''
+    return {'accuracy': 1.0 * (tp + tn) / (tn + fp + fn + tp),
+            'precision': 1.0 * tp / (tp + fp),
+            'recall': 1.0 * tp / (tp + fn),
+            'f1': 2.0 * tp / (2 * tp + fp + fn)}
+
+def auc_score(y_true, y_scores):
+    '''
+    This function calculates the area under the ROC curve.
+    Input:
+        y_true: np.array with the observed Ys 
+        y_scores: np.array with the predicted scores
+    Output:
+        The AUC score
+    '''
+    from sklearn.metrics import roc_auc_score
+    return roc_auc_score(y_true, y_scores)
+
+def top_k_labels(scores, k):
+    '''
+    This function labels as 1 the k highest scores and 0 the rest, without a
+    full sort. Ties at the cutoff go to the earliest observations, the same
+    way a stable sort by descending score ranks them (see get_results).
+    Input:
+        scores: np.array with the predicted scores
+        k: number of observations labeled 1
+    Output:
+        np.array with the predicted labels {0, 1}
+    '''
+    arr = np.asarray(scores)
+    n = len(arr)
+    out = np.zeros(n, dtype=np.int8)
+    if k >= n:
+        out[:] = 1
+    elif k > 0:
+        # k-th highest score
+        thr = np.partition(arr, n - k)[n - k]
+        above = arr > thr
+        out[above] = 1
+        # fill the remaining positions with the first scores tied at the cutoff
+        out[np.flatnonzero(arr == thr)[:k - above.sum()]] = 1
+    return out
+
 def scores_pctpop(pred_scores, pct_pop):
-    
+    '''
+    This function labels as 1 the highest scored observations that make up
+    the target percent of the population, and 0 the rest.
+    Input:
+        pred_scores: np.array with the predicted scores
+        pct_pop: percentage of the population labeled 1
+    Output:
+        np.array with the predicted labels {0, 1}
+    '''
     #identify number of positives to have given target percent of population
     num_pos = int(round(len(pred_scores)*(pct_pop/100),0))
-    #turn predictions into series
-    tmp = pred_scores.copy()
-    pred_df = pd.Series(tmp)
-    idx = pred_df.sort_values(ascending=False)[0:num_pos].index 
-    
-    #set all observations to 0
-    pred_df.iloc[:] = 0
-    #set observations by index (the ones ranked high enough) to 1
-    #from IPython import embed; embed()
-    pred_df.iloc[idx] = 1
-    
-    return list(pred_df)
+    return top_k_labels(pred_scores, num_pos)
 
 def pred_at_level(y_true, y_scores, level):
     '''
@@ -504,21 +556,17 @@ def pred_at_level(y_true, y_scores, level):
         y_scores: np.array with the predicted scores 
         level: percentage of the population labeled 1
     Output:
-        The predicted label {0, 1}
+        The observed Ys and the predicted label {0, 1}, in the original order
     '''
-    
-    idx = np.argsort(np.array(y_scores))[::-1]
-    y_scores, y_true = np.array(y_scores)[idx], np.array(y_true)[idx]
     cutoff_index = int(len(y_scores) * (level / 100.0))
-    y_preds_at_level = [1 if x < cutoff_index else 0 for x in range(len(y_scores))]
-    return y_true, y_preds_at_level
+    return np.asarray(y_true), top_k_labels(y_scores, cutoff_index)
 
 
 metrics = { 'accuracy':accuracy_at_threshold,
             'precision':precision_at_threshold,
             'recall':recall_at_threshold,
             'f1':f1_at_threshold,
-            'auc':roc_auc_score}
+            'auc':auc_score}
 
 
 # Understanding Best models #
@@ -535,16 +583,16 @@ def get_best_models(df, time_col, test_years, cols, metric):
     
     Return dataframe of best model for the specified metric
     '''
-    best_models = pd.DataFrame(columns= cols)
+    best_models = []
 
     for year in test_years:
         year_data = df[df[time_col]==year]
         highest = year_data[metric].max()
         model = year_data[year_data[metric] == highest]
         print("For train-test set {}, highest {} attained is {}".format(year, metric, highest))
-        best_models = best_models.append(model[cols])
+        best_models.append(model[cols])
 
-    return best_models
+    return pd.concat(best_models, ignore_index=True) if best_models else pd.DataFrame(columns= cols)
 
 def sort_models(data, metric, top_k, cols):
     '''
@@ -561,12 +609,12 @@ def get_stability_score(trainsets, metric, cols):
     Inputs:
         trainsets: list of dataframes that correspond to each traintest set
     '''
-    result = pd.DataFrame()
+    ranked = []
     for sets in trainsets:
         sort = sets.sort_values(metric, ascending=False)
         sort['rank'] = range(len(sort))
-        result = result.append(sort)
-    result = result[cols + ['rank']]
+        ranked.append(sort[cols + ['rank']])
+    result = pd.concat(ranked, ignore_index=True)
     return result.groupby(['classifiers','parameters']).mean().sort_values('rank')
 
 
@@ -583,6 +631,8 @@ def get_metric_graph(df, metric, model_and_para, baseline, train_test_col,
         baseline: list of baselines over the train test sets
         title: title of graph
     '''
+    import matplotlib.pyplot as plt
+
     def get_data(df, dic, model, para, metric, train_test_col, train_test_val):
         '''
         Getting the data points to plot
@@ -624,17 +674,30 @@ def get_metric_graph(df, metric, model_and_para, baseline, train_test_col,
 
 ### Master Classifier
 
-classifiers = { 'RF': RandomForestClassifier(n_jobs=-1, random_state=config.SEED),
-                'ET': ExtraTreesClassifier(n_jobs=-1, criterion='entropy', random_state=config.SEED),
-                'AB': AdaBoostClassifier(DecisionTreeClassifier(max_depth=1), random_state=config.SEED),
-                'GB': GradientBoostingClassifier(learning_rate=0.05, subsample=0.5, max_depth=6,
-                                                n_estimators=10, random_state=config.SEED),
-                'KNN': KNeighborsClassifier(n_neighbors=3),
-                'DT': DecisionTreeClassifier(max_depth=5, random_state=config.SEED),
-                'SVM': LinearSVC(random_state=config.SEED),
-                'LR': LogisticRegression(penalty='l1', C=1e5, random_state=config.SEED),
-                'BAG': BaggingClassifier(random_state=config.SEED),
-                'NB': MultinomialNB(alpha=1.0)
+def get_classifiers():
+    '''
+    This function creates the classifiers with their default parameters
+    Returns a dictionary of classifiers by model name
+    '''
+    from sklearn.neighbors import KNeighborsClassifier
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.svm import LinearSVC
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.ensemble import (RandomForestClassifier, ExtraTreesClassifier,
+    GradientBoostingClassifier, AdaBoostClassifier, BaggingClassifier)
+
+    return { 'RF': RandomForestClassifier(n_jobs=-1, random_state=config.SEED),
+             'ET': ExtraTreesClassifier(n_jobs=-1, criterion='entropy', random_state=config.SEED),
+             'AB': AdaBoostClassifier(DecisionTreeClassifier(max_depth=1), random_state=config.SEED),
+             'GB': GradientBoostingClassifier(learning_rate=0.05, subsample=0.5, max_depth=6,
+                                             n_estimators=10, random_state=config.SEED),
+             'KNN': KNeighborsClassifier(n_neighbors=3),
+             'DT': DecisionTreeClassifier(max_depth=5, random_state=config.SEED),
+             'SVM': LinearSVC(random_state=config.SEED),
+             'LR': LogisticRegression(penalty='l1', C=1e5, random_state=config.SEED),
+             'BAG': BaggingClassifier(random_state=config.SEED),
+             'NB': MultinomialNB(alpha=1.0)
         }
 
 def plot_bias(model_name, bias_df, bias_metrics = ['ppr','pprev','fnr','fpr', 'for'], min_group_size = None, output_type = None):
@@ -643,6 +706,10 @@ def plot_bias(model_name, bias_df, bias_metrics = ['ppr','pprev','fnr','fpr', 'f
 
     bias_df = dataframe with ID, label, predicted scores already taking into account the population threshold, and 
     '''
+    import matplotlib.pyplot as plt
+    from aequitas.group import Group
+    from aequitas.plotting import Plot
+
     g = Group()
     xtab, _ = g.get_crosstabs(bias_df)
     aqp = Plot()
@@ -651,6 +718,7 @@ def plot_bias(model_name, bias_df, bias_metrics = ['ppr','pprev','fnr','fpr', 'f
     if output_type == 'save':
         pltfile = os.path.join(config.GRAPH_FOLDER,model_name)
         p.savefig(pltfile)
+        plt.close('all')
     elif output_type == 'show':
         p.show()
     return
@@ -666,6 +734,11 @@ def visualize_tree(dt, feature_labels, class_labels, filename, save):
         save: True or False
     Saves a png
     '''
+    from io import StringIO
+    import graphviz
+    import pydotplus
+    from sklearn import tree
+
     dot_data = StringIO()
     graphviz.Source(tree.export_graphviz(dt, out_file=dot_data,
                                          feature_names=feature_labels,
@@ -686,6 +759,10 @@ def get_feature_importance(clfr, features, filename, save):
         save: True or False
     Return a dataframe of feature importance
     '''
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.svm import LinearSVC
+    from sklearn.naive_bayes import MultinomialNB
+
     d = {'Features': features}
     if (isinstance(clfr, LogisticRegression) or
         isinstance(clfr, LinearSVC) or 
@@ -721,10 +798,21 @@ def get_results(test_set, label, eval_metrics, eval_metrics_by_level, eval_resul
     if eval_metrics_by_level[0]:
         precision = []
         recall = []
+        # rank observations by score once, then count true positives among
+        # the top k observations for every k in a single cumulative pass
+        order = np.argsort(-np.asarray(y_pred_prob), kind='stable')
+        y_test_ordered = np.asarray(y_test)[order]
+        n = len(y_test_ordered)
+        n_pos = y_test_ordered.sum()
+        tp_cum = np.concatenate(([0], np.cumsum(y_test_ordered)))
         for level in eval_metrics_by_level[1]:
-            y_pred = scores_pctpop(y_pred_prob, level)
+            # same number of positives as scores_pctpop
+            k = min(int(round(n*(level/100),0)), n)
+            tp = tp_cum[k]
+            fp = k - tp
+            level_scores = metrics_from_counts(n - n_pos - fp, fp, n_pos - tp, tp)
             for metric in eval_metrics_by_level[0]:
-                score = metrics[metric](y_test, y_pred)
+                score = level_scores[metric]
                 if metric == 'precision':
                     precision.append(score)
                 elif metric == 'recall':
@@ -737,16 +825,104 @@ def get_results(test_set, label, eval_metrics, eval_metrics_by_level, eval_resul
         print('plotting precision recall for {}'.format(model_name))
         text = 'Recall at {} is {}'.format(threshold, round(rec,3))
         # add last point on curve at 100%
-        y_pred = scores_pctpop(y_pred_prob,100)
         thresholds = eval_metrics_by_level[1] + [100]
-        precision.append(precision_at_threshold(y_test, y_pred))
-        recall.append(recall_at_threshold(y_test, y_pred))
+        level_scores = metrics_from_counts(0, n - n_pos, 0, n_pos)
+        precision.append(level_scores['precision'])
+        recall.append(level_scores['recall'])
         # plot graph
         plot_precision_recall_n(precision, recall, thresholds, model_name, text, plot_pr)
     return eval_result
 
+def fit_and_evaluate(classifier, X_train, y_train, X_test, test_set, label, model, parameters, attributes_lst, bias_lst, bias_dict,
+    year, genders, eval_metrics, eval_metrics_by_level, baseline, plot_pr = None, compute_bias = False, save_pred = False, n_jobs = 1):
+    '''
+    This function fits one classifier with the given parameters and evaluates it on the test set
+    Input:
+        classifier: classifier with its default parameters
+        X_train, y_train, X_test: features (np.array) and label for training, features (np.array) for testing
+        test_set: dataframe with the test set columns needed for evaluation (see classify)
+        model: name of the classifier to fit
+        parameters: dictionary of parameters for the classifier
+        n_jobs: number of models being fit in parallel
+        (see classify for the rest of the inputs)
+    Output:
+        list containing one row of performance measures for each gender
+    '''
+    from sklearn.base import clone
+    from sklearn.tree import DecisionTreeClassifier
+    from sklearn.svm import LinearSVC
+
+    print('Running model: {}, param: {}'.format(model, parameters))
+    # set parameters on a fresh copy of the classifier
+    clfr = clone(classifier).set_params(**parameters)
+    # describe the model by its configured parameters, before any n_jobs override,
+    # and keep only the string so the fitted model is not sent back with the results
+    classifier_desc = repr(clfr)
+    # models already run in parallel, so avoid oversubscribing the cores
+    if n_jobs != 1 and 'n_jobs' in clfr.get_params():
+        clfr.set_params(n_jobs=1)
+    clfr.fit(X_train, y_train)
+
+    # visualize decision tree
+    if isinstance(clfr, DecisionTreeClassifier):
+        filename = '{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
+        visualize_tree(clfr, attributes_lst, ['No','Yes'], filename, config.VISUALIZE_DT)
+    
+    # Get feature importance
+    filename = 'FIMPORTANCE_{}_{}_{}.csv'.format(year, model, str(parameters).replace(':','-'))
+    get_feature_importance(clfr, attributes_lst, filename, config.FEATURE_IMP)
+
+    # calculate scores
+    if isinstance(clfr, LinearSVC):
+        y_pred_prob = clfr.decision_function(X_test)
+    else:    
+        y_pred_prob = clfr.predict_proba(X_test)[:,1]
+
+    # add score to a copy of the data, so the caller's frame is never modified
+    test_set = test_set.copy()
+    test_set['SCORE'] = y_pred_prob
+    # plot and save score distributions if desired
+    if config.SAVE_HIST:
+        model_name = 'HIST_{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
+        plot_scores_hist(test_set, 'SCORE', model_name, output_type = 'save')
+
+    # Calculate final label
+    test_set['PREDICTION'] = scores_pctpop(y_pred_prob, config.POP_THRESHOLD)
+    # save final predictions to file
+    if save_pred:
+        filename = 'PRED_{}_{}_{}.csv'.format(year, model, str(parameters).replace(':','-'))
+        f = os.path.join(config.RESULTS_DIR,filename)
+        final_pred = test_set.loc[:, ['ID', 'PREFIX', 'START_DATE', 'END_DATE', 'LABEL', 'SCORE','PREDICTION']]
+        final_pred.to_csv(f, index=False)
+    
+    # plot bias metrics if desired
+    if compute_bias:
+        # take only the bias columns from the test set, with the names aequitas expects
+        bias_names = {'ID': 'id', 'PREDICTION': 'score', label: 'label_value'}
+        source_names = {v: k for k, v in bias_names.items()}
+        bias_df = test_set[[source_names.get(c, c) for c in bias_lst]].rename(columns=bias_names)
+        # plot and save bias
+        model_name = 'BIAS_{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
+        plot_bias(model_name, bias_df, bias_metrics = bias_dict['metrics'], 
+            min_group_size = bias_dict['min_group_size'], output_type = 'save')
+
+    results = []
+    for gender in genders:
+        if gender != 'TOTAL':
+            gender_dummy = 'INMATE_GENDER_CODE_' + gender
+            test_set_g = test_set[test_set[gender_dummy]==1]
+            test_set_g.reset_index(drop=True, inplace=True)
+        else:
+            test_set_g = test_set
+        eval_result = [year, gender, model, classifier_desc, parameters, len(X_train), len(attributes_lst), len(X_test), baseline]
+        model_name = 'PRC_{}_{}_{}_{}.png'.format(year, gender, model, str(parameters).replace(':','-'))   
+        eval_result = get_results(test_set_g, label, eval_metrics, eval_metrics_by_level, eval_result, config.POP_THRESHOLD, model_name, plot_pr)
+        results.append(eval_result)
+    return results
+
 def classify(train_set, test_set, label, models, eval_metrics, eval_metrics_by_level, custom_grid, attributes_lst, bias_lst, bias_dict, year, genders,
-    scaler, variables, results_dir, results_file, plot_pr = None, compute_bias =False, save_pred=False):
+    scaler, variables, results_dir, results_file, plot_pr = None, compute_bias =False, save_pred=False, n_jobs=config.N_JOBS,
+    n_iter=config.N_ITER):
     '''
     This function fits a set of classifiers and a dataframe with performance measures for each
     Input:
@@ -767,18 +943,18 @@ def classify(train_set, test_set, label, models, eval_metrics, eval_metrics_by_l
         plot_pr: 'save', 'show', or None
         compute_bias: boolean whether or not to compute bias for each model
         save_pred: boolean whether to save final predictions
+        n_jobs: number of (model, parameters) combinations to fit in parallel (1 if plot_pr is 'show')
+        n_iter: maximum number of parameter combinations to sample from each model's grid (None for the full grid)
     Output:
         Dataframe containing performance measures for each classifier
     '''
+    from sklearn.model_selection import ParameterGrid, ParameterSampler
+    from joblib import Parallel, delayed
+
     #initialize results
+    classifiers = get_classifiers()
     results_columns = (['year','gender','model','classifiers', 'parameters', 'train_set_size', 'num_features', 'validation_set_size', 'baseline'] + eval_metrics + 
                       [metric + '_' + str(level) for level in eval_metrics_by_level[1] for metric in eval_metrics_by_level[0]])
-    
-    # Write header for the csv
-    outfile = os.path.join(results_dir, "{}_{}.csv".format(results_file, year))
-    with open(outfile, "w") as f:
-        csvwriter = csv.writer(f, delimiter=',')
-        csvwriter.writerow(results_columns)
 
     # subset training and test sets 
     X_train = train_set.loc[:, attributes_lst]
@@ -795,82 +971,77 @@ def classify(train_set, test_set, label, models, eval_metrics, eval_metrics_by_l
             print(attributes_lst, file=f)
     print('features_{}.txt file created'.format(year))
 
-    # iterate through models
+    # features for each model, converted once to contiguous float32 arrays;
+    # joblib memory-maps large arrays for the workers instead of pickling them per task
+    X_train_arr = np.ascontiguousarray(X_train.to_numpy(dtype=np.float32))
+    X_test_arr = np.ascontiguousarray(X_test.to_numpy(dtype=np.float32))
+    model_data = {}
     for model in models:
         # if DT, unscale attributes for visualization and classifier
         if model == 'DT':
             cont = variables['CONTINUOUS_VARS_MINMAX']
-            X_train[cont] = scaler.inverse_transform(X_train[cont])
-            X_test[cont] = scaler.inverse_transform(X_test[cont])
-
-        #create parameters grids
-        grid = ParameterGrid(custom_grid[model])
-        # iterate through parameters for given model
-        for parameters in grid:
-            classifier = classifiers[model]
-            print('Running model: {}, param: {}'.format(model, parameters))
-            # set parameters
-            clfr = classifier.set_params(**parameters)
-            clfr.fit(X_train, y_train)
-
-            # visualize decision tree
-            if isinstance(clfr, DecisionTreeClassifier):
-                filename = '{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
-                visualize_tree(clfr, attributes_lst, ['No','Yes'], filename, config.VISUALIZE_DT)
-            
-            # Get feature importance
-            filename = 'FIMPORTANCE_{}_{}_{}.csv'.format(year, model, str(parameters).replace(':','-'))
-            get_feature_importance(clfr, attributes_lst, filename, config.FEATURE_IMP)
-
-            # calculate scores
-            if isinstance(clfr, LinearSVC):
-                y_pred_prob = clfr.decision_function(X_test)
-            else:    
-                y_pred_prob = clfr.predict_proba(X_test)[:,1]
-
-            # add score to data
-            test_set['SCORE'] = y_pred_prob
-            # plot and save score distributions
-            model_name = 'HIST_{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
-            plot_scores_hist(test_set, 'SCORE', model_name, output_type = 'save')
-
-            # Calculate final label
-            test_set['PREDICTION'] = scores_pctpop(y_pred_prob, config.POP_THRESHOLD)
-            # save final predictions to file
-            if save_pred:
-                filename = 'PRED_{}_{}_{}.csv'.format(year, model, str(parameters).replace(':','-'))
-                f = os.path.join(config.RESULTS_DIR,filename)
-                final_pred = test_set.loc[:, ['ID', 'PREFIX', 'START_DATE', 'END_DATE', 'LABEL', 'SCORE','PREDICTION']]
-                final_pred.to_csv(f, index=False)
-            
-            # plot bias metrics if desired
-            if compute_bias:
-                # reconfigure test set to have the correct column names
-                tmp = test_set.copy()
-                tmp['id'] = tmp['ID']
-                tmp['score'] = tmp['PREDICTION']
-                tmp['label_value'] = tmp[label]
-                bias_df = tmp.loc[:, bias_lst]
-                # plot and save bias
-                model_name = 'BIAS_{}_{}_{}.png'.format(year, model, str(parameters).replace(':','-'))
-                plot_bias(model_name, bias_df, bias_metrics = bias_dict['metrics'], 
-                    min_group_size = bias_dict['min_group_size'], output_type = 'save')
-
-            for gender in genders:
-                if gender != 'TOTAL':
-                    gender_dummy = 'INMATE_GENDER_CODE_' + gender
-                    test_set_g = test_set[test_set[gender_dummy]==1]
-                    test_set_g.reset_index(drop=True, inplace=True)
-                else:
-                    test_set_g = test_set
-                eval_result = [year, gender, model, classifier, parameters, len(X_train), len(attributes_lst), len(X_test), baseline]
-                model_name = 'PRC_{}_{}_{}_{}.png'.format(year, gender, model, str(parameters).replace(':','-'))   
-                eval_result = get_results(test_set_g, label, eval_metrics, eval_metrics_by_level, eval_result, config.POP_THRESHOLD, model_name, plot_pr)
-
-            # writing out results in csv file
-                with open(outfile, "a") as f:
-                    csvwriter = csv.writer(f)
-                    csvwriter.writerow(eval_result)
-
-            
+            X_train_dt = X_train.copy()
+            X_test_dt = X_test.copy()
+            X_train_dt[cont] = scaler.inverse_transform(X_train_dt[cont])
+            X_test_dt[cont] = scaler.inverse_transform(X_test_dt[cont])
+            model_data[model] = (np.ascontiguousarray(X_train_dt.to_numpy(dtype=np.float32)),
+                                 np.ascontiguousarray(X_test_dt.to_numpy(dtype=np.float32)))
+        # keep double precision for naive bayes
+        elif model == 'NB':
+            model_data[model] = (np.ascontiguousarray(X_train.to_numpy(dtype=np.float64)),
+                                 np.ascontiguousarray(X_test.to_numpy(dtype=np.float64)))
+        else:
+            model_data[model] = (X_train_arr, X_test_arr)
+
+    # only the columns needed to evaluate each model are sent to the workers,
+    # the features are already in the arrays above
+    eval_cols = [label, 'ID'] + ['INMATE_GENDER_CODE_' + g for g in genders if g != 'TOTAL']
+    if compute_bias:
+        # the score (PREDICTION) is added by each model
+        source_names = {'id': 'ID', 'label_value': label}
+        eval_cols += [source_names.get(c, c) for c in bias_lst if c != 'score']
+    if save_pred:
+        eval_cols += ['ID', 'PREFIX', 'START_DATE', 'END_DATE', 'LABEL']
+    eval_set = test_set.loc[:, list(dict.fromkeys(eval_cols))]
+
+    # sample at most n_iter parameter combinations from each model's grid
+    grids = {}
+    for model in models:
+        grid_size = len(ParameterGrid(custom_grid[model]))
+        sample_size = grid_size if n_iter is None else min(n_iter, grid_size)
+        sampler = ParameterSampler(custom_grid[model], n_iter=sample_size, random_state=config.SEED)
+        # sort the keys like ParameterGrid does, so result columns and filenames stay comparable
+        grids[model] = [dict(sorted(parameters.items())) for parameters in sampler]
+
+    if plot_pr == 'show':
+        # plots can only be shown from the main process
+        n_jobs = 1
 
+    # keep a single buffered writer open for the whole grid
+    outfile = os.path.join(results_dir, "{}_{}.csv".format(results_file, year))
+    with open(outfile, "w", newline='', buffering=1<<20) as f:
+        # Write header for the csv
+        csvwriter = csv.writer(f, delimiter=',')
+        csvwriter.writerow(results_columns)
+
+        # worker processes only save plots to file, so start them without the
+        # interactive backend, and leave the caller's environment as it was
+        prev_backend = os.environ.get('MPLBACKEND')
+        if n_jobs != 1:
+            os.environ['MPLBACKEND'] = 'Agg'
+        try:
+            # fit and evaluate every (model, parameters) combination in parallel
+            results = Parallel(n_jobs=n_jobs, backend='loky')(
+                delayed(fit_and_evaluate)(classifiers[model], model_data[model][0], y_train, model_data[model][1], eval_set, label, model, parameters,
+                    attributes_lst, bias_lst, bias_dict, year, genders, eval_metrics, eval_metrics_by_level, baseline,
+                    plot_pr, compute_bias, save_pred, n_jobs)
+                for model in models for parameters in grids[model])
+        finally:
+            if prev_backend is None:
+                os.environ.pop('MPLBACKEND', None)
+            else:
+                os.environ['MPLBACKEND'] = prev_backend
+
+        # writing out results in csv file
+        for model_results in results:
+            csvwriter.writerows(model_results)